@@ -1,9 +1,19 @@
+import hashlib
+import itertools
+import json
+import re
 import os
-from datetime import datetime
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
 from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 
-from flask import Flask, jsonify, render_template, request, send_file, session
-from psycopg.rows import dict_row
+import orjson
+from flask import Flask, Response, jsonify, render_template, request, send_file, session, stream_with_context
+from flask.sessions import SecureCookieSessionInterface
+from psycopg.rows import dict_row, tuple_row
 from psycopg_pool import ConnectionPool
 
 
@@ -13,8 +23,205 @@ app.secret_key = os.environ.get("SECRET_KEY", _default_secret)
 if app.secret_key == _default_secret:
     app.logger.warning("SECRET_KEY no configurada; usando valor inseguro solo para desarrollo")
 
+# Con REDIS_URL la sesion pasa al servidor: la cookie se reduce a un id y
+# desaparece el firmar/verificar HMAC del payload completo en cada peticion,
+# ademas de permitir invalidar sesiones entre workers. Sin REDIS_URL se
+# mantiene la cookie firmada de Flask.
+class _CachedCookieSessionInterface(SecureCookieSessionInterface):
+    """
+    open_session con cache TTL por hash de la cookie: las peticiones
+    repetidas de la misma sesion (el panel admin sondea varios endpoints
+    cada pocos segundos) se saltan la verificacion HMAC y la
+    deserializacion del payload. Un cambio de sesion emite cookie nueva,
+    asi que el peor caso es servir datos de sesion con hasta TTL de retraso.
+    """
+
+    TTL = 30
+    MAX_ENTRADAS = 1024
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._cache: dict[bytes, tuple[float, dict]] = {}
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        valor = request.cookies.get(self.get_cookie_name(app))
+        if not valor:
+            return super().open_session(app, request)
+
+        clave = hashlib.blake2b(valor.encode(), digest_size=16).digest()
+        ahora = time.monotonic()
+
+        with self._lock:
+            entrada = self._cache.get(clave)
+        if entrada is not None and entrada[0] > ahora:
+            return self.session_class(entrada[1])
+
+        sesion = super().open_session(app, request)
+        if sesion:
+            with self._lock:
+                if len(self._cache) >= self.MAX_ENTRADAS:
+                    self._cache.clear()
+                self._cache[clave] = (ahora + self.TTL, dict(sesion))
+        return sesion
+
+
+_redis_url = os.environ.get("REDIS_URL")
+_redis = None
+if _redis_url:
+    import redis
+    from flask_session import Session
+
+    _redis = redis.Redis.from_url(_redis_url)
+    app.config.update(
+        SESSION_TYPE="redis",
+        SESSION_REDIS=_redis,
+        SESSION_USE_SIGNER=True,
+        PERMANENT_SESSION_LIFETIME=timedelta(hours=8),
+    )
+    Session(app)
+else:
+    # Solo sobre la sesion de cookie por defecto; con flask-session el
+    # interface lo gestiona Redis
+    app.session_interface = _CachedCookieSessionInterface()
+
+# Compresion gzip de las respuestas grandes: CSV y JSON de lecturas son muy
+# repetitivos (EANs, timestamps) y comprimen 5-10x, que en despliegues
+# remotos pesa mas que la CPU de comprimir. El xlsx ya es un zip, asi que
+# se deja fuera. La compresion es incremental y no rompe el streaming.
+try:
+    from flask_compress import Compress
+except ImportError:  # dependencia opcional; sin ella se sirve sin comprimir
+    Compress = None
+
+if Compress is not None:
+    app.config["COMPRESS_MIMETYPES"] = ["text/csv", "application/json", "text/html"]
+    app.config["COMPRESS_LEVEL"] = 5
+    Compress(app)
+
+# Cache de resultados con TTL corto para los endpoints que sondea el panel
+# de admin: colapsa rafagas de polling en una sola consulta a Postgres.
+# Sin Redis los helpers son no-op y cada peticion va a la base de datos.
+CACHE_TTL = int(os.environ.get("CACHE_TTL_SEGUNDOS", "5"))
+
+
+def _cache_get(clave: str):
+    if _redis is None:
+        return None
+    try:
+        valor = _redis.get(clave)
+    except Exception:
+        return None
+    return json.loads(valor) if valor is not None else None
+
+
+def _cache_set(clave: str, valor) -> None:
+    if _redis is None:
+        return
+    try:
+        _redis.setex(clave, CACHE_TTL, json.dumps(valor, default=str))
+    except Exception:
+        pass
+
+
+def _cache_delete(*claves: str) -> None:
+    if _redis is None:
+        return
+    try:
+        _redis.delete(*claves)
+    except Exception:
+        pass
+
 _pool: ConnectionPool | None = None
-_schema_ready = False
+
+# SQL caliente con texto estable a nivel de modulo: con prepare_threshold=1
+# cada conexion del pool prepara el plan en la primera ejecucion y lo
+# reutiliza, ahorrando el parse/plan por peticion sobre el enlace TLS
+_SQL_LOGIN = "SELECT id, es_admin FROM usuarios WHERE nombre_usuario = %s"
+_SQL_FIND_ARTICULO = "SELECT codigo_articulo, descripcion FROM articulos WHERE ean = %s"
+_SQL_INSERT_LECTURA = """
+    INSERT INTO lecturas (usuario, ean, codigo_articulo, descripcion)
+    VALUES (%s, %s, %s, %s)
+"""
+# Busqueda + insercion en una sola sentencia (CTE escribible): si el EAN no
+# esta en el maestro no se inserta nada y RETURNING no devuelve fila
+_SQL_ESCANEAR = """
+    WITH art AS (
+        SELECT codigo_articulo, descripcion FROM articulos WHERE ean = %s
+    )
+    INSERT INTO lecturas (usuario, ean, codigo_articulo, descripcion)
+    SELECT %s, %s, codigo_articulo, descripcion FROM art
+    RETURNING id, codigo_articulo, descripcion
+"""
+# SQL del pipeline de importacion, construido una vez al cargar el modulo
+_SQL_CREAR_STAGING = (
+    "CREATE TEMP TABLE articulos_staging (LIKE articulos INCLUDING DEFAULTS) ON COMMIT DROP"
+)
+_SQL_COPY_STAGING = "COPY articulos_staging (codigo_articulo, descripcion, ean) FROM STDIN"
+_SQL_COPY_STAGING_CSV = (
+    "COPY articulos_staging (codigo_articulo, descripcion, ean) "
+    "FROM STDIN WITH (FORMAT csv, HEADER true)"
+)
+_SQL_UPSERT_STAGING = """
+    INSERT INTO articulos (codigo_articulo, descripcion, ean)
+    SELECT DISTINCT ON (ean) codigo_articulo, descripcion, ean
+    FROM articulos_staging
+    WHERE codigo_articulo <> '' AND ean ~ '^[0-9]+$'
+    ORDER BY ean
+    ON CONFLICT (ean) DO UPDATE
+        SET codigo_articulo = EXCLUDED.codigo_articulo,
+            descripcion = EXCLUDED.descripcion
+"""
+# El filtro IS NOT NULL es imprescindible: el COPY csv mete NULL por cada
+# celda de EAN vacia, y un solo NULL en el subquery haria que NOT IN
+# evaluara a NULL para todas las filas (el borrado seria un no-op silencioso)
+_SQL_BORRAR_AUSENTES = (
+    "DELETE FROM articulos WHERE ean NOT IN "
+    "(SELECT ean FROM articulos_staging WHERE ean IS NOT NULL)"
+)
+
+# Normalizacion del import. Definidas a nivel de modulo (no por peticion) y
+# con tabla de traduccion precomputada: str.translate recorre la cadena en C,
+# frente a la cadena de tres replace() que habia antes.
+_TABLA_SIN_BLANCOS = str.maketrans("", "", " \t\n\r")
+_NO_DIGITOS = re.compile(r"\D+")
+
+
+def _norm_str(x) -> str:
+    return str(x).strip() if x is not None else ""
+
+
+def _norm_ean(x) -> str:
+    # Soporta EAN como int/float/cientifico/string
+    if x is None:
+        return ""
+    if isinstance(x, int):
+        return str(x)
+    if isinstance(x, float):
+        return str(int(x)) if x.is_integer() else _NO_DIGITOS.sub("", str(x))
+
+    s = str(x).translate(_TABLA_SIN_BLANCOS)
+    # Caso comun (EAN ya limpio): sin regex ni pasadas extra
+    if s.isdigit():
+        return s
+
+    if "e" in s or "E" in s:
+        try:
+            s = str(int(float(s)))
+        except Exception:
+            pass
+
+    # La sustitucion regex recorre la cadena en C, frente al generador
+    # caracter a caracter que habia antes
+    return _NO_DIGITOS.sub("", s)
+
+
+# Constantes del export xlsx: se definen una vez en vez de reconstruirse en
+# cada peticion (el objeto Format en si es por-workbook en xlsxwriter, pero
+# su especificacion y las cabeceras/anchos no necesitan recrearse)
+_EXPORT_HEADERS = ["EAN", "Codigo Articulo", "Descripcion", "Fecha"]
+_EXPORT_HEADER_FMT = {"bold": True, "font_color": "#FFFFFF", "bg_color": "#121212"}
+_EXPORT_COL_WIDTHS = (("A:A", 20), ("B:B", 18), ("C:C", 40), ("D:D", 18))
 
 
 def _normalize_database_url(raw_url: str) -> str:
@@ -35,10 +242,6 @@ def _ensure_schema(pool: ConnectionPool) -> None:
     Crea tablas e indices necesarios de forma idempotente.
     Importante: usa pool.connection() directo para no llamar get_db()/get_pool() y evitar recursion.
     """
-    global _schema_ready
-    if _schema_ready:
-        return
-
     with pool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
@@ -80,6 +283,12 @@ def _ensure_schema(pool: ConnectionPool) -> None:
                 """
             )
 
+            # /api/lecturas y los exports ordenan por fecha_lectura DESC; sin
+            # indice cada llamada degenera en seq scan + sort al crecer la tabla
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS lecturas_fecha_idx ON lecturas (fecha_lectura DESC)"
+            )
+
             # Usuarios admin por defecto (idempotente)
             cursor.execute(
                 "INSERT INTO usuarios (nombre_usuario, es_admin) VALUES (%s, %s) ON CONFLICT (nombre_usuario) DO NOTHING",
@@ -92,10 +301,19 @@ def _ensure_schema(pool: ConnectionPool) -> None:
 
         conn.commit()
 
-    _schema_ready = True
-
 
 def get_pool() -> ConnectionPool:
+    """
+    Pool de conexiones del proceso.
+
+    Con Neon conviene apuntar DATABASE_URL al endpoint con sufijo -pooler
+    (pgbouncer en modo transaccion): la adquisicion de conexion sale casi
+    gratis y el handshake TLS se amortiza entre instancias. En ese caso,
+    bajar PGPOOL_MAX_SIZE (p.ej. 5, pgbouncer ya multiplexa) y poner
+    PGPOOL_PREPARE_THRESHOLD=none, porque el pooling por transaccion rompe
+    las sentencias preparadas. Contra el endpoint directo (pooling de
+    sesion) se pueden mantener los preparados con el umbral por defecto.
+    """
     global _pool
     if _pool is None:
         database_url = os.environ.get("DATABASE_URL")
@@ -103,22 +321,139 @@ def get_pool() -> ConnectionPool:
             raise RuntimeError("DATABASE_URL no configurada")
 
         conninfo = _normalize_database_url(database_url)
+
+        # none/vacio desactiva las sentencias preparadas (necesario detras
+        # de pgbouncer/pooler en modo transaccion)
+        _prepare = os.environ.get("PGPOOL_PREPARE_THRESHOLD", "1").strip().lower()
+        prepare_threshold = None if _prepare in ("", "none") else int(_prepare)
+
+        # Regla de dimensionado: max_size <= max_connections de Postgres
+        # dividido por el numero de instancias de la app. Con 3 conexiones
+        # los escaneos concurrentes se serializaban en el pool.
         _pool = ConnectionPool(
             conninfo=conninfo,
-            min_size=int(os.environ.get("PGPOOL_MIN_SIZE", 1)),
-            max_size=int(os.environ.get("PGPOOL_MAX_SIZE", 3)),
-            kwargs={"row_factory": dict_row},
+            min_size=int(os.environ.get("PGPOOL_MIN_SIZE", 4)),
+            max_size=int(os.environ.get("PGPOOL_MAX_SIZE", 25)),
+            timeout=10,
+            max_waiting=100,
+            # Neon corta conexiones inactivas; check descarta las rotas al
+            # prestarlas en vez de dejar que la peticion falle
+            check=ConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row, "prepare_threshold": prepare_threshold},
+            open=False,
         )
+        # Abrir esperando min_size: la primera peticion no paga el TLS frio
+        _pool.open(wait=True, timeout=30)
+
+        # Esquema y writer se preparan una sola vez junto al pool; el camino
+        # caliente de get_db() ya no comprueba nada por peticion
+        _ensure_schema(_pool)
+        _arrancar_writer_lecturas()
 
-    # Garantiza esquema (una sola vez por instancia)
-    _ensure_schema(_pool)
     return _pool
 
 
 def get_db():
+    """
+    Context manager sobre una conexion prestada del pool: al salir la
+    devuelve (commit implicito si no hubo error, rollback si lo hubo), asi
+    que ningun endpoint paga TCP+TLS+auth por peticion.
+    """
     return get_pool().connection()
 
 
+def ojson(obj, status: int = 200) -> Response:
+    """
+    Respuesta JSON serializada con orjson (C): ~5-10x mas rapido que el
+    encoder stdlib y maneja datetime/UUID de forma nativa. Para las listas
+    grandes (lecturas, usuarios); los dicts pequenos siguen con jsonify.
+    """
+    return app.response_class(orjson.dumps(obj), status=status, mimetype="application/json")
+
+
+# Cache en proceso del maestro de articulos. La tabla solo cambia en
+# importaciones o limpiezas (poco frecuentes), asi que un hit convierte el
+# escaneo en una consulta de diccionario y evita el viaje TLS a Neon.
+_articulos_cache: dict[str, tuple[str, str]] = {}
+_articulos_cache_lock = threading.RLock()
+
+
+def _buscar_articulo(ean: str) -> dict | None:
+    with _articulos_cache_lock:
+        cacheado = _articulos_cache.get(ean)
+    if cacheado is not None:
+        return {"codigo_articulo": cacheado[0], "descripcion": cacheado[1]}
+
+    with get_db() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(_SQL_FIND_ARTICULO, (ean,))
+            articulo = cursor.fetchone()
+
+    if articulo:
+        with _articulos_cache_lock:
+            _articulos_cache[ean] = (articulo["codigo_articulo"], articulo["descripcion"])
+
+    return articulo
+
+
+def _invalidar_cache_articulos() -> None:
+    with _articulos_cache_lock:
+        _articulos_cache.clear()
+
+
+# Escritor en segundo plano para lecturas: cada escaneo encola su fila y el
+# hilo demonio agrupa hasta LECTURAS_BATCH_MAX filas (o las que lleguen en
+# LECTURAS_BATCH_WAIT_MS) en una sola transaccion, amortizando el commit y
+# el viaje de red entre muchos escaneos. La pequena ventana de consistencia
+# eventual es aceptable para un inventario por codigo de barras.
+_lecturas_queue: queue.Queue = queue.Queue()
+_lecturas_writer_started = False
+_lecturas_writer_lock = threading.Lock()
+
+LECTURAS_BATCH_MAX = int(os.environ.get("LECTURAS_BATCH_MAX", "500"))
+LECTURAS_BATCH_WAIT = int(os.environ.get("LECTURAS_BATCH_WAIT_MS", "50")) / 1000.0
+
+# Con LECTURAS_WRITER_ASYNC=0 cada escaneo se persiste en linea usando la
+# CTE escribible (_SQL_ESCANEAR): un unico viaje y commit por lectura, util
+# cuando la durabilidad inmediata importa mas que el throughput
+LECTURAS_WRITER_ASYNC = os.environ.get("LECTURAS_WRITER_ASYNC", "1") != "0"
+
+
+def _escribir_lecturas() -> None:
+    while True:
+        lote = [_lecturas_queue.get()]
+        limite = time.monotonic() + LECTURAS_BATCH_WAIT
+        while len(lote) < LECTURAS_BATCH_MAX:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                lote.append(_lecturas_queue.get(timeout=restante))
+            except queue.Empty:
+                break
+
+        try:
+            with get_db() as conn:
+                with conn.cursor() as cursor:
+                    # En psycopg3 executemany ya agrupa el lote en modo
+                    # pipeline (un solo viaje y un Sync), el equivalente
+                    # moderno de execute_values en psycopg2
+                    cursor.executemany(_SQL_INSERT_LECTURA, lote)
+                conn.commit()
+        except Exception:
+            app.logger.exception("Error persistiendo lote de %d lecturas", len(lote))
+
+
+def _arrancar_writer_lecturas() -> None:
+    global _lecturas_writer_started
+    if _lecturas_writer_started:
+        return
+    with _lecturas_writer_lock:
+        if not _lecturas_writer_started:
+            threading.Thread(target=_escribir_lecturas, name="lecturas-writer", daemon=True).start()
+            _lecturas_writer_started = True
+
+
 @app.route("/")
 def index():
     return render_template("login.html")
@@ -134,7 +469,7 @@ def login():
 
     with get_db() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT id, es_admin FROM usuarios WHERE nombre_usuario = %s", (usuario,))
+            cursor.execute(_SQL_LOGIN, (usuario,))
             user = cursor.fetchone()
 
     if not user:
@@ -170,29 +505,45 @@ def escanear():
     if not ean:
         return jsonify({"success": False, "message": "Codigo de barras vacio"}), 400
 
-    with get_db() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT codigo_articulo, descripcion FROM articulos WHERE ean = %s", (ean,))
-            articulo = cursor.fetchone()
+    if not LECTURAS_WRITER_ASYNC:
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(_SQL_ESCANEAR, (ean, session.get("usuario", "anonimo"), ean))
+                fila = cursor.fetchone()
+            conn.commit()
 
-            if not articulo:
-                return jsonify({"success": False, "message": f"El codigo {ean} no esta en el maestro"}), 404
+        if not fila:
+            return jsonify({"success": False, "message": f"El codigo {ean} no esta en el maestro"}), 404
+
+        _cache_delete("lecturas:top100")
+        return jsonify(
+            {
+                "success": True,
+                "message": "Articulo encontrado y registrado",
+                "lectura": {
+                    "id": fila["id"],
+                    "ean": ean,
+                    "codigo_articulo": fila["codigo_articulo"],
+                    "descripcion": fila["descripcion"],
+                },
+            }
+        )
 
-            cursor.execute(
-                """
-                INSERT INTO lecturas (usuario, ean, codigo_articulo, descripcion)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-                """,
-                (
-                    session.get("usuario", "anonimo"),
-                    ean,
-                    articulo["codigo_articulo"],
-                    articulo["descripcion"],
-                ),
-            )
-            lectura_id = cursor.fetchone()["id"]
-        conn.commit()
+    articulo = _buscar_articulo(ean)
+    if not articulo:
+        return jsonify({"success": False, "message": f"El codigo {ean} no esta en el maestro"}), 404
+
+    # Id temporal del lado cliente; la fila se persiste en lote por el writer
+    lectura_id = str(uuid.uuid4())
+    _lecturas_queue.put(
+        (
+            session.get("usuario", "anonimo"),
+            ean,
+            articulo["codigo_articulo"],
+            articulo["descripcion"],
+        )
+    )
+    _cache_delete("lecturas:top100")
 
     return jsonify(
         {
@@ -210,6 +561,10 @@ def escanear():
 
 @app.route("/api/lecturas", methods=["GET"])
 def obtener_lecturas():
+    cacheado = _cache_get("lecturas:top100")
+    if cacheado is not None:
+        return ojson(cacheado)
+
     with get_db() as conn:
         with conn.cursor() as cursor:
             cursor.execute(
@@ -221,7 +576,15 @@ def obtener_lecturas():
                 """
             )
             lecturas = cursor.fetchall()
-    return jsonify(lecturas)
+
+    # fecha en ISO para que hit y miss de cache devuelvan el mismo formato
+    for lectura in lecturas:
+        fecha = lectura["fecha_lectura"]
+        if isinstance(fecha, datetime):
+            lectura["fecha_lectura"] = fecha.isoformat()
+
+    _cache_set("lecturas:top100", lecturas)
+    return ojson(lecturas)
 
 
 @app.route("/api/lecturas/limpiar", methods=["DELETE"])
@@ -230,18 +593,37 @@ def limpiar_lecturas():
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM lecturas")
         conn.commit()
+    _cache_delete("lecturas:top100")
     return jsonify({"success": True, "message": "Lecturas eliminadas"})
 
 
 @app.route("/api/exportar", methods=["GET"])
 def exportar_excel():
-    from io import BytesIO
+    from tempfile import NamedTemporaryFile
+
+    import xlsxwriter
+
+    tmp = NamedTemporaryFile(suffix=".xlsx", delete=False)
+    tmp.close()
 
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill
+    # constant_memory vuelca cada fila a disco segun se escribe, asi que la
+    # memoria es O(1 fila); el emisor XML de xlsxwriter es ademas mas rapido
+    # por celda que el grafo de objetos de openpyxl
+    wb = xlsxwriter.Workbook(tmp.name, {"constant_memory": True, "use_zip64": True})
+    ws = wb.add_worksheet("Lecturas")
+
+    for columnas, ancho in _EXPORT_COL_WIDTHS:
+        ws.set_column(columnas, ancho)
+
+    header_fmt = wb.add_format(_EXPORT_HEADER_FMT)
+    ws.write_row(0, 0, _EXPORT_HEADERS, header_fmt)
 
     with get_db() as conn:
-        with conn.cursor() as cursor:
+        # Cursor con nombre = portal en el servidor: las filas llegan en
+        # tandas de itersize en vez de materializarse todas con fetchall()
+        # tuple_row: sin construir un dict por fila exportada
+        with conn.cursor(name="export_lecturas", row_factory=tuple_row) as cursor:
+            cursor.itersize = 2000
             cursor.execute(
                 """
                 SELECT ean, codigo_articulo, descripcion, fecha_lectura
@@ -249,48 +631,325 @@ def exportar_excel():
                 ORDER BY fecha_lectura DESC
                 """
             )
-            lecturas = cursor.fetchall()
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Lecturas"
-    headers = ["EAN", "Codigo Articulo", "Descripcion", "Fecha"]
-    ws.append(headers)
 
-    for cell in ws[1]:
-        cell.font = Font(bold=True, color="FFFFFF")
-        cell.fill = PatternFill(start_color="121212", end_color="121212", fill_type="solid")
+            for i, (ean, codigo, descripcion, fecha_valor) in enumerate(cursor, start=1):
+                if isinstance(fecha_valor, datetime):
+                    fecha_formateada = fecha_valor.strftime("%d/%m/%Y %H:%M")
+                else:
+                    fecha_formateada = str(fecha_valor) if fecha_valor else ""
 
-    for row in lecturas:
-        fecha_valor = row["fecha_lectura"]
-        if isinstance(fecha_valor, datetime):
-            fecha_formateada = fecha_valor.strftime("%d/%m/%Y %H:%M")
-        else:
-            fecha_formateada = str(fecha_valor) if fecha_valor else ""
+                ws.write_row(i, 0, (ean, codigo, descripcion or "", fecha_formateada))
 
-        ws.append([row["ean"], row["codigo_articulo"], row["descripcion"] or "", fecha_formateada])
-
-    ws.column_dimensions["A"].width = 20
-    ws.column_dimensions["B"].width = 18
-    ws.column_dimensions["C"].width = 40
-    ws.column_dimensions["D"].width = 18
-
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
+    wb.close()
 
     filename = f"lecturas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
 
-    return send_file(
-        output,
+    response = send_file(
+        tmp.name,
         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
         as_attachment=True,
         download_name=filename,
     )
+    response.call_on_close(lambda: os.unlink(tmp.name))
+    return response
+
+
+@app.route("/api/exportar.csv", methods=["GET"])
+def exportar_csv():
+    """
+    Alternativa CSV al export xlsx: Postgres serializa con COPY (en C) y
+    Flask solo reenvia los bytes, asi que CPU y memoria en Python quedan
+    practicamente planas sea cual sea el tamano de la tabla.
+    """
+    filename = f"lecturas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+
+    def gen():
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                with cursor.copy(
+                    """
+                    COPY (
+                        SELECT ean, codigo_articulo, descripcion,
+                               to_char(fecha_lectura, 'DD/MM/YYYY HH24:MI') AS fecha
+                        FROM lecturas
+                        ORDER BY fecha_lectura DESC
+                    ) TO STDOUT WITH CSV HEADER
+                    """
+                ) as cp:
+                    for chunk in cp:
+                        yield bytes(chunk)
+
+    return Response(
+        stream_with_context(gen()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={filename}"},
+    )
 
 
 # === ARTICULOS ===
 
+def _preparar_staging(cursor) -> None:
+    """Ajusta los GUCs de carga masiva y crea la tabla staging temporal."""
+    # Commit asincrono solo para esta transaccion: evita esperar el fsync
+    # del WAL al confirmar la carga masiva. Si el servidor cayera justo
+    # despues, se reimporta el fichero.
+    cursor.execute("SET LOCAL synchronous_commit = off")
+    # Memoria extra solo durante la carga: work_mem para que el anti-join
+    # del DELETE ... NOT IN quepa en un hash, y maintenance_work_mem por si
+    # hay que reconstruir indices
+    cursor.execute("SET LOCAL work_mem = '64MB'")
+    cursor.execute("SET LOCAL maintenance_work_mem = '256MB'")
+
+    # Carga en staging + upsert en una sola transaccion: los escaneos
+    # concurrentes siguen viendo el maestro anterior hasta el commit (nada
+    # de ventana con la tabla vacia) y el indice de ean se mantiene
+    # incremental en vez de reconstruirse
+    cursor.execute(_SQL_CREAR_STAGING)
+
+
+def _reconciliar_staging(cursor) -> int:
+    """
+    Vuelca staging al maestro (upsert + borrado de ausentes) y devuelve el
+    numero de filas aplicadas por el upsert.
+    """
+    # DISTINCT ON cubre cualquier duplicado que llegue a staging (el upsert
+    # fallaria al tocar la misma fila dos veces) y el WHERE revalida en SQL
+    # lo que filtra el parseo en Python: nada invalido puede llegar al
+    # maestro aunque cambie el camino de carga
+    cursor.execute(_SQL_UPSERT_STAGING)
+    aplicadas = cursor.rowcount
+
+    # El fichero importado es autoritativo: lo que no venga en el se retira
+    # del maestro
+    cursor.execute(_SQL_BORRAR_AUSENTES)
+
+    # Estadisticas frescas para el planificador y para la estimacion por
+    # reltuples de /api/articulos/count
+    cursor.execute("ANALYZE articulos")
+
+    return aplicadas
+
+# Trabajos de importacion en segundo plano: el POST devuelve 202 con un
+# job_id al instante y un hilo demonio hace parseo+COPY, liberando el worker
+# HTTP (y su socket) durante toda la carga. El estado se consulta por
+# /api/articulos/importar/<job_id>.
+_import_jobs: dict[str, dict] = {}
+_import_jobs_lock = threading.Lock()
+_IMPORT_JOB_RETENCION = 3600  # segundos que se conserva un trabajo terminado
+
+
+def _registrar_import_job() -> tuple[str, dict]:
+    job_id = uuid.uuid4().hex
+    job = {"estado": "procesando", "mensaje": None, "importadas": 0, "creado": time.time()}
+    with _import_jobs_lock:
+        # Poda perezosa de trabajos viejos ya terminados
+        caducados = [
+            jid for jid, j in _import_jobs.items()
+            if j["estado"] != "procesando" and time.time() - j["creado"] > _IMPORT_JOB_RETENCION
+        ]
+        for jid in caducados:
+            del _import_jobs[jid]
+        _import_jobs[job_id] = job
+    return job_id, job
+
+
+def _ejecutar_importacion(ruta_xlsx: str, job: dict) -> None:
+    """
+    Cuerpo del import xlsx: parsea el fichero en ruta_xlsx y lo vuelca al
+    maestro via staging. Corre en un hilo de fondo; progreso y resultado se
+    publican en el dict del trabajo.
+    """
+
+    def iter_filas():
+        """
+        Itera las filas de datos del xlsx (sin cabecera) como tuplas crudas.
+        Usa calamine (parser Rust, varias veces mas rapido y sin objeto Cell
+        por celda) si esta instalado; si no, cae a openpyxl read_only.
+        """
+        try:
+            from python_calamine import CalamineWorkbook
+        except ImportError:
+            from openpyxl import load_workbook
+
+            # read_only=True reduce memoria y suele ir mejor con archivos grandes
+            wb = load_workbook(ruta_xlsx, data_only=True, read_only=True)
+            ws = wb.active
+            # max_col=3: el parser read_only corta cada fila tras la columna
+            # C en vez de materializar celdas de columnas que no se usan
+            yield from ws.iter_rows(min_row=2, max_col=3, values_only=True)
+            return
+
+        wb = CalamineWorkbook.from_path(ruta_xlsx)
+        filas = wb.get_sheet_by_index(0).to_python(skip_empty_area=True)
+
+        # islice en vez de filas[1:]: evita duplicar la lista de filas solo
+        # para saltar la cabecera
+        yield from itertools.islice(filas, 1, None)
+
+    contadores = {"filas": 0, "descartadas": 0, "duplicadas": 0}
+
+    def filas_normalizadas():
+        """
+        Genera tuplas (codigo, descripcion, ean) ya normalizadas y filtradas.
+        Con pandas instalado la normalizacion se hace por columnas en C
+        (fillna/str.replace vectorizados sobre arrays columnares) en vez de
+        fila a fila en Python, y las tuplas salen de itertuples directas al
+        COPY; si no, cae al bucle por filas sobre iter_filas().
+        """
+        try:
+            import pandas as pd
+        except ImportError:
+            # EANs ya vistos: un duplicado en el fichero abortaria el upsert
+            # (mismo ean dos veces en la misma sentencia), asi que se filtra
+            # aqui y ni siquiera viaja por el COPY
+            vistos: set[str] = set()
+
+            # Alias locales: evita la busqueda por nombre global en cada
+            # una de las ~3N llamadas del bucle
+            norm_str = _norm_str
+            norm_ean = _norm_ean
+
+            for row in iter_filas():
+                contadores["filas"] += 1
+
+                codigo_articulo = norm_str(row[0] if len(row) > 0 else None)
+                descripcion = norm_str(row[1] if len(row) > 1 else None)
+                ean = norm_ean(row[2] if len(row) > 2 else None)
+
+                if not codigo_articulo or not ean:
+                    contadores["descartadas"] += 1
+                    continue
+
+                if ean in vistos:
+                    contadores["duplicadas"] += 1
+                    continue
+
+                vistos.add(ean)
+                yield (codigo_articulo, descripcion, ean)
+            return
+
+        try:
+            import python_calamine  # noqa: F401
+            engine = "calamine"
+        except ImportError:
+            engine = "openpyxl"
+
+        df = pd.read_excel(
+            ruta_xlsx,
+            engine=engine,
+            dtype=str,
+            header=0,
+            usecols=[0, 1, 2],
+            names=["codigo", "descripcion", "ean"],
+        )
+        df = df.fillna("")
+        # Equivalente vectorizado de norm_str/norm_ean: quita el sufijo .0
+        # que deja Excel en celdas numericas y deja solo digitos en el EAN
+        df["codigo"] = df["codigo"].str.strip().str.replace(r"\.0$", "", regex=True)
+        df["descripcion"] = df["descripcion"].str.strip()
+        df["ean"] = df["ean"].str.strip().str.replace(r"\.0$", "", regex=True)
+        # EANs en notacion cientifica ("8.43457E+12"): quitar lo no-numerico
+        # los corromperia, asi que esas filas (raras) pasan por _norm_ean,
+        # que las convierte via int(float(s)) igual que el camino por filas
+        cientificos = df["ean"].str.contains(r"[eE]", regex=True)
+        if cientificos.any():
+            df.loc[cientificos, "ean"] = df.loc[cientificos, "ean"].map(_norm_ean)
+        df["ean"] = df["ean"].str.replace(r"\D", "", regex=True)
+
+        # Misma semantica que el camino por filas: EANs duplicados en el
+        # fichero se descartan quedandose con la primera aparicion
+        validas = df[(df["codigo"] != "") & (df["ean"] != "")]
+        sin_duplicados = validas.drop_duplicates(subset="ean", keep="first")
+        contadores["filas"] = len(df)
+        contadores["descartadas"] = len(df) - len(validas)
+        contadores["duplicadas"] = len(validas) - len(sin_duplicados)
+        yield from sin_duplicados.itertuples(index=False, name=None)
+
+    try:
+        importados = 0
+
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                _preparar_staging(cursor)
+
+                # COPY enmarca el protocolo directamente: cada fila sale hacia
+                # Postgres segun se parsea el xlsx, sin lotes intermedios y con
+                # memoria O(1 fila). psycopg se encarga del escapado de texto.
+                # Productor/consumidor: el parseo+normalizado del xlsx (CPU
+                # en Python) se solapa con el envio del COPY (I/O de socket,
+                # que libera el GIL). Las filas viajan en bloques para no
+                # pagar un put/get por fila; la cola acotada limita la RAM.
+                cola: queue.Queue = queue.Queue(maxsize=16)
+                _FIN_IMPORT = None
+                errores_parseo: list[Exception] = []
+
+                def producir():
+                    bloque = []
+                    try:
+                        for fila in filas_normalizadas():
+                            bloque.append(fila)
+                            if len(bloque) >= 200:
+                                cola.put(bloque)
+                                bloque = []
+                    except Exception as exc:  # re-lanzado en el hilo principal
+                        errores_parseo.append(exc)
+                    finally:
+                        if bloque:
+                            cola.put(bloque)
+                        cola.put(_FIN_IMPORT)
+
+                productor = threading.Thread(target=producir, name="import-parser", daemon=True)
+                productor.start()
+
+                fin_visto = False
+                try:
+                    with cursor.copy(_SQL_COPY_STAGING) as copia:
+                        while True:
+                            bloque = cola.get()
+                            if bloque is _FIN_IMPORT:
+                                fin_visto = True
+                                break
+                            for fila in bloque:
+                                copia.write_row(fila)
+                            importados += len(bloque)
+                            job["importadas"] = importados
+                finally:
+                    # Si el COPY falla a mitad, el productor quedaria
+                    # bloqueado para siempre en put() sobre la cola llena:
+                    # se drena hasta el centinela para que el hilo (y su
+                    # memoria) termine siempre
+                    while not fin_visto:
+                        fin_visto = cola.get() is _FIN_IMPORT
+                    productor.join()
+
+                if errores_parseo:
+                    raise errores_parseo[0]
+
+                _reconciliar_staging(cursor)
+
+            conn.commit()
+
+        _invalidar_cache_articulos()
+        _cache_delete("articulos:count")
+
+        job["mensaje"] = (
+            f"Importacion OK. Filas leidas: {contadores['filas']}. "
+            f"Importadas: {importados}. Descartadas: {contadores['descartadas']}. "
+            f"Duplicadas: {contadores['duplicadas']}."
+        )
+        job["estado"] = "completado"
+
+    except Exception as e:
+        job["mensaje"] = f"Error: {str(e)}"
+        job["estado"] = "error"
+
+    finally:
+        try:
+            os.unlink(ruta_xlsx)
+        except OSError:
+            pass
+
+
 @app.route("/api/articulos/importar", methods=["POST"])
 def importar_articulos():
     if not session.get("es_admin"):
@@ -306,83 +965,86 @@ def importar_articulos():
     if not archivo.filename.lower().endswith((".xlsx", ".xls")):
         return jsonify({"success": False, "message": "El archivo debe ser Excel (.xlsx o .xls)"}), 400
 
-    # Ajustable: 1000–5000 suele ir bien
-    BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", "2000"))
-
-    def norm_str(x):
-        return str(x).strip() if x is not None else ""
-
-    def norm_ean(x):
-        # Soporta EAN como int/float/científico/string
-        if x is None:
-            return ""
-        if isinstance(x, int):
-            s = str(x)
-        elif isinstance(x, float):
-            s = str(int(x)) if x.is_integer() else str(x)
-        else:
-            s = str(x).strip()
-
-        s = s.replace(" ", "").replace("\t", "").replace("\n", "")
-        if "e" in s.lower():
-            try:
-                s = str(int(float(s)))
-            except Exception:
-                pass
+    from tempfile import NamedTemporaryFile
 
-        return "".join(ch for ch in s if ch.isdigit())
+    # El upload se persiste a un temporal y el resto corre en segundo plano:
+    # el worker HTTP queda libre durante todo el parseo+COPY
+    tmp = NamedTemporaryFile(suffix=".xlsx", delete=False)
+    archivo.save(tmp)
+    tmp.close()
 
-    try:
-        from openpyxl import load_workbook
+    job_id, job = _registrar_import_job()
+    threading.Thread(
+        target=_ejecutar_importacion, args=(tmp.name, job), name=f"import-{job_id[:8]}", daemon=True
+    ).start()
 
-        # read_only=True reduce memoria y suele ir mejor con archivos grandes
-        wb = load_workbook(archivo, data_only=True, read_only=True)
-        ws = wb.active
+    return jsonify({"success": True, "job_id": job_id, "estado": job["estado"]}), 202
 
-        total_filas = 0
-        descartadas = 0
-        importados = 0
-        batch = []
 
-        insert_sql = """
-            INSERT INTO articulos (codigo_articulo, descripcion, ean)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (ean) DO NOTHING
-        """
+@app.route("/api/articulos/importar/<job_id>", methods=["GET"])
+def estado_importacion(job_id: str):
+    if not session.get("es_admin"):
+        return jsonify({"success": False, "message": "No autorizado"}), 403
 
-        with get_db() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM articulos")
+    with _import_jobs_lock:
+        job = _import_jobs.get(job_id)
 
-                for row in ws.iter_rows(min_row=2, values_only=True):
-                    total_filas += 1
+    if job is None:
+        return jsonify({"success": False, "message": "Trabajo no encontrado"}), 404
 
-                    codigo_articulo = norm_str(row[0] if len(row) > 0 else None)
-                    descripcion = norm_str(row[1] if len(row) > 1 else None)
-                    ean = norm_ean(row[2] if len(row) > 2 else None)
+    return jsonify(
+        {
+            "success": job["estado"] != "error",
+            "estado": job["estado"],
+            "importadas": job["importadas"],
+            "message": job["mensaje"],
+        }
+    )
 
-                    if not codigo_articulo or not ean:
-                        descartadas += 1
-                        continue
 
-                    batch.append((codigo_articulo, descripcion, ean))
+@app.route("/api/articulos/importar_csv", methods=["POST"])
+def importar_articulos_csv():
+    """
+    Variante CSV del import: se salta el parseo de xlsx por completo y deja
+    que Postgres interprete el CSV en C via COPY; Python solo bombea bytes.
+    Espera cabecera y columnas codigo_articulo, descripcion, ean. La
+    validacion y dedup corren en SQL al reconciliar staging.
+    """
+    if not session.get("es_admin"):
+        return jsonify({"success": False, "message": "No autorizado"}), 403
 
-                    if len(batch) >= BATCH_SIZE:
-                        cursor.executemany(insert_sql, batch)
-                        importados += len(batch)
-                        batch.clear()
+    if "archivo" not in request.files:
+        return jsonify({"success": False, "message": "No se recibio ningun archivo"}), 400
+
+    archivo = request.files["archivo"]
+    if archivo.filename == "":
+        return jsonify({"success": False, "message": "Nombre de archivo vacio"}), 400
+
+    if not archivo.filename.lower().endswith(".csv"):
+        return jsonify({"success": False, "message": "El archivo debe ser CSV (.csv)"}), 400
 
-                # flush final
-                if batch:
-                    cursor.executemany(insert_sql, batch)
-                    importados += len(batch)
-                    batch.clear()
+    try:
+        with get_db() as conn:
+            with conn.cursor() as cursor:
+                _preparar_staging(cursor)
+
+                with cursor.copy(_SQL_COPY_STAGING_CSV) as copia:
+                    while True:
+                        trozo = archivo.stream.read(65536)
+                        if not trozo:
+                            break
+                        copia.write(trozo)
+
+                aplicadas = _reconciliar_staging(cursor)
 
             conn.commit()
 
+        _invalidar_cache_articulos()
+        _cache_delete("articulos:count")
+
         return jsonify({
             "success": True,
-            "message": f"Importacion OK. Filas leidas: {total_filas}. Importadas (intentadas): {importados}. Descartadas: {descartadas}. Batch: {BATCH_SIZE}."
+            "message": f"Importacion CSV OK. Filas aplicadas: {aplicadas}."
         })
 
     except Exception as e:
@@ -391,11 +1053,29 @@ def importar_articulos():
 
 @app.route("/api/articulos/count", methods=["GET"])
 def contar_articulos():
+    cacheado = _cache_get("articulos:count")
+    if cacheado is not None:
+        return jsonify(cacheado)
+
     with get_db() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT COUNT(*) AS total FROM articulos")
-            count = cursor.fetchone()["total"]
-    return jsonify({"count": count})
+        with conn.cursor(row_factory=tuple_row) as cursor:
+            # Estimacion del planificador: O(1) frente al seq scan de
+            # COUNT(*). El import hace ANALYZE al terminar, asi que para un
+            # contador de UI la cifra es suficientemente exacta.
+            cursor.execute(
+                "SELECT reltuples::bigint FROM pg_class WHERE relname = 'articulos'"
+            )
+            fila = cursor.fetchone()
+            count = fila[0] if fila else -1
+
+            if count < 0:
+                # Tabla aun sin analizar: unico caso que paga el conteo real
+                cursor.execute("SELECT COUNT(*) FROM articulos")
+                (count,) = cursor.fetchone()
+
+    respuesta = {"count": count}
+    _cache_set("articulos:count", respuesta)
+    return jsonify(respuesta)
 
 
 @app.route("/api/articulos/limpiar", methods=["DELETE"])
@@ -407,6 +1087,13 @@ def limpiar_articulos():
         with conn.cursor() as cursor:
             cursor.execute("DELETE FROM articulos")
         conn.commit()
+        with conn.cursor() as cursor:
+            # Refresca reltuples: sin esto /api/articulos/count seguiria
+            # mostrando el total previo hasta que pasara autovacuum
+            cursor.execute("ANALYZE articulos")
+
+    _invalidar_cache_articulos()
+    _cache_delete("articulos:count")
 
     return jsonify({"success": True, "message": "Tabla maestra limpiada"})
 
@@ -419,13 +1106,22 @@ def obtener_usuarios():
         return jsonify({"success": False, "message": "No autorizado"}), 403
 
     with get_db() as conn:
-        with conn.cursor() as cursor:
+        # tuple_row + proyeccion explicita: el unico dict por fila es el que
+        # necesita la respuesta JSON
+        with conn.cursor(row_factory=tuple_row) as cursor:
+            # prepare=True fija el plan desde la primera llamada, aunque la
+            # conexion no alcance el prepare_threshold del pool
             cursor.execute(
-                "SELECT id, nombre_usuario, es_admin, fecha_creacion FROM usuarios ORDER BY fecha_creacion DESC"
+                "SELECT id, nombre_usuario, es_admin, fecha_creacion FROM usuarios ORDER BY fecha_creacion DESC",
+                prepare=True,
             )
-            usuarios = cursor.fetchall()
+            filas = cursor.fetchall()
 
-    return jsonify(usuarios)
+    usuarios = [
+        {"id": f[0], "nombre_usuario": f[1], "es_admin": f[2], "fecha_creacion": f[3]}
+        for f in filas
+    ]
+    return ojson(usuarios)
 
 
 @app.route("/api/admin/usuarios", methods=["POST"])
@@ -448,6 +1144,7 @@ def crear_usuario():
                 RETURNING id
                 """,
                 (nombre, False),
+                prepare=True,
             )
             nuevo = cursor.fetchone()
         conn.commit()
@@ -465,21 +1162,42 @@ def eliminar_usuario(usuario_id: int):
 
     with get_db() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT nombre_usuario FROM usuarios WHERE id = %s", (usuario_id,))
-            user = cursor.fetchone()
+            # Una sola sentencia: la regla de administradores protegidos viaja
+            # dentro del DELETE, asi que se ahorra un viaje y se cierra la
+            # carrera entre comprobar y borrar
+            cursor.execute(
+                """
+                DELETE FROM usuarios
+                WHERE id = %s AND nombre_usuario NOT IN ('admin', 'henkobit')
+                RETURNING nombre_usuario
+                """,
+                (usuario_id,),
+            )
+            borrado = cursor.fetchone()
+
+            if borrado is None:
+                # Solo en el caso raro: distinguir inexistente de protegido
+                cursor.execute("SELECT nombre_usuario FROM usuarios WHERE id = %s", (usuario_id,))
+                user = cursor.fetchone()
 
-            if not user:
-                return jsonify({"success": False, "message": "Usuario no encontrado"}), 404
+                if not user:
+                    return jsonify({"success": False, "message": "Usuario no encontrado"}), 404
 
-            if user["nombre_usuario"] in ["admin", "henkobit"]:
                 return jsonify({"success": False, "message": "No se puede eliminar este administrador"}), 400
 
-            cursor.execute("DELETE FROM usuarios WHERE id = %s", (usuario_id,))
         conn.commit()
 
     return jsonify({"success": True, "message": "Usuario eliminado"})
 
 
+# Inicializacion anticipada: con DATABASE_URL presente, pool + esquema se
+# preparan al importar el modulo (arranque del worker), fallando rapido en
+# vez de en la primera peticion. Sin la variable se mantiene el arranque
+# perezoso y el error llega al primer uso, como antes.
+if os.environ.get("DATABASE_URL"):
+    get_pool()
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host="0.0.0.0", port=port)